@@ -1,7 +1,7 @@
 from enum import Enum
 from typing import List, Dict, Optional, Any, Tuple
 
-from pydantic import BaseModel
+import msgspec 
 
 class REQUEST_TYPE(str, Enum):
         TIME2SLEEP:str='time2sleep' 
@@ -13,6 +13,16 @@ class Role(str, Enum):
     SYSTEM:str='system'
     ASSISTANT:str='assistant'
 
-class Message(BaseModel):
+class Message(msgspec.Struct, frozen=True, gc=False):  # frozen => instances can be shared between conversations 
     role:Role 
-    content:str 
\ No newline at end of file
+    content:str 
+
+    @classmethod
+    def from_dict(cls, data:Dict[str, Any]) -> 'Message':
+        return msgspec.from_builtins(data, type=cls)  # validates role and content, extra keys (refusal, ...) are ignored 
+
+    def dict(self) -> Dict[str, str]:
+        return {'role': self.role, 'content': self.content}  # Role is already a str
+
+    def to_json_bytes(self) -> bytes:
+        return msgspec.json.encode(self)
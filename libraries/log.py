@@ -1,7 +1,7 @@
 import logging 
 
 logging.basicConfig(
-    format='%(asctime)s | %(name)s >> %(filename)10s:%(lineno)03d %(levelname)7s %(message)s',
+    format='%(created).3f | %(name)s >> %(filename)10s:%(lineno)03d %(levelname)7s %(message)s',
     level=logging.DEBUG
 )
 
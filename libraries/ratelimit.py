@@ -0,0 +1,25 @@
+import asyncio
+
+from time import monotonic
+
+class GCRALimiter:
+    def __init__(self, nb_cells_per_mn:int, burst:float):
+        self.emission_interval = 60 / float(nb_cells_per_mn)  # 0.02s for 3000 reqs
+        self.delay_tolerance = self.emission_interval * burst
+        self.tat = 0.0  # theoretical arrival time of the next cell
+
+    def charge(self, nb_cells:int):  # a negative nb_cells refunds previously charged cells
+        now = monotonic()  # independent of the running loop
+        self.tat = max(self.tat, now) + nb_cells * self.emission_interval
+
+    def wait_time(self, nb_cells:int) -> float:
+        now = monotonic()
+        cost = min(nb_cells * self.emission_interval, self.delay_tolerance)  # bigger than the burst => wait for an empty bucket
+        return max(self.tat, now) + cost - self.delay_tolerance - now
+
+    async def acquire(self, nb_cells:int=1):
+        delay = self.wait_time(nb_cells)
+        while delay > 0:  # cells refunded while sleeping are taken into account at wake up
+            await asyncio.sleep(delay)
+            delay = self.wait_time(nb_cells)
+        self.charge(nb_cells)  # no await after the check => the first waiter to wake up consumes the room
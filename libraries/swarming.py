@@ -1,221 +1,232 @@
-import zmq 
-import zmq.asyncio as aiozmq 
-
 from uuid import uuid4
 
 import httpx 
+import msgspec 
 import signal 
 import asyncio
 
-from time import time 
+from tenacity import AsyncRetrying, retry_if_exception, stop_after_attempt, wait_exponential_jitter
 from libraries.log import logger 
+from libraries.ratelimit import GCRALimiter
 
 
 from typing import List, Dict, Optional, Any, Tuple
-from dataschema import Role, Message, REQUEST_TYPE
+from dataschema import Message, REQUEST_TYPE
+
+RETRYABLE_STATUS_CODES = frozenset({429, 500, 502, 503})
+MAX_CHOICES_PER_REQUEST = 128  # upper bound of the openai `n` parameter 
+
+def is_retryable(error:BaseException) -> bool:
+    if isinstance(error, httpx.TransportError):  # timeouts, dropped connections, http2 protocol errors 
+        return True 
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in RETRYABLE_STATUS_CODES  # rate limit or transient server error 
+    return False 
 
 class GPTSwarm:
-    def __init__(self, openai_api_key:str, nb_tokens_per_mn:int, nb_requests_per_mn:int, model_token_size:int):
+    def __init__(self, openai_api_key:str, nb_tokens_per_mn:int, nb_requests_per_mn:int, model_token_size:int, max_concurrent:int=64):
         self.openai_api_key = openai_api_key
         self.nb_tokens_per_mn = nb_tokens_per_mn
         self.nb_requests_per_mn = nb_requests_per_mn
 
         self.model_token_size = model_token_size
-        self.period = 1 / float(self.nb_requests_per_mn / 60)  # 0.02s for 3000 reqs
+        self.max_concurrent = max_concurrent
 
-        self.collector_address = 'inproc://collector_endpoint'
         self.headers = {
             'Content-Type': 'application/json',
             'Authorization': f'Bearer {self.openai_api_key}'
         }
+        self._limits = httpx.Limits(
+            max_connections=2 * self.max_concurrent,  # the pool should never be the binding constraint 
+            max_keepalive_connections=self.max_concurrent, 
+            keepalive_expiry=30.0
+        )
+        self._timeout = httpx.Timeout(10.0, connect=5.0)
+
+        # limiters are loop agnostic => created once, their budget survives repeated enters 
+        self.rpm_limiter = GCRALimiter(
+            nb_cells_per_mn=self.nb_requests_per_mn, 
+            burst=self.nb_requests_per_mn
+        )
+        self.tpm_limiter = GCRALimiter(
+            nb_cells_per_mn=self.nb_tokens_per_mn, 
+            burst=self.nb_tokens_per_mn  # in-flight requests are covered by their reservation 
+        )
+        # a request with n choices reserves n * model_token_size tokens => the reservation must fit in the TPM burst 
+        self.max_choices_per_request = max(1, min(
+            MAX_CHOICES_PER_REQUEST, 
+            self.nb_tokens_per_mn // self.model_token_size
+        ))
         
     def stop_swarm(self):
-        logger.info('stop-swarming was called ...!')
-        running_task = asyncio.all_tasks(self.loop)
-        for task in running_task:
-            if task.get_name().startswith('worker-'):
-                task.cancel()
-
-    async def collector(self):
-        pull_socket:aiozmq.Socket = self.ctx.socket(zmq.PULL) 
-        pull_socket.bind(self.collector_address)
-
+        logger.info('stop-swarming was called => %d running swarm(s) will return their partial responses', len(self.active_swarms))
+        for conversations_queue, pool_tasks in self.active_swarms.items():  # finished swarm calls are no longer registered 
+            self.drain_conversations(conversations_queue)  # prevent the pool from picking up new conversations 
+            for task in pool_tasks:
+                task.cancel()  # no-op for the tasks that are already done 
+
+    def drain_conversations(self, conversations_queue:asyncio.Queue):
+        while not conversations_queue.empty():
+            conversations_queue.get_nowait()
+
+    async def worker_strategy(self, post_response:httpx.Response, reserved_tokens:int) -> Tuple[List[Message], int]:
+        post_response.raise_for_status()  # error status codes are classified by the worker retry policy 
+        content = msgspec.json.decode(post_response.content)
+        consumed_tokens = content['usage']['total_tokens']
+        outgoing_messages = [ Message.from_dict(choice['message']) for choice in content['choices'] ]
+        self.tpm_limiter.charge(consumed_tokens - reserved_tokens)  # settle the reservation, negative => refund 
+        return outgoing_messages, consumed_tokens
+
+    async def worker(self, worker_id:str, nb_retries:int, messages:List[Message], nb_choices:int=1) -> Tuple[List[Optional[Message]], int]:
+        outgoing_messages:List[Optional[Message]] = [None] * nb_choices  
+        consumed_tokens = 0  # stays at 0 when every attempt failed 
+        payload = msgspec.json.encode({
+            'model': 'gpt-3.5-turbo',
+            'messages': messages,  # msgspec serializes the Message structs natively 
+            'n': nb_choices
+        })  # the request body is invariant across retries 
+        
+        reserved_tokens = nb_choices * self.model_token_size  # upper bound of the tokens used by one attempt 
+        retrying = AsyncRetrying(
+            stop=stop_after_attempt(nb_retries),
+            wait=wait_exponential_jitter(initial=1, max=30),
+            retry=retry_if_exception(is_retryable),
+            reraise=True 
+        )
         try:
-            start = time()
-            keep_loop = True 
-            while keep_loop:
-                socket_status = await pull_socket.poll(timeout=100)
-                if socket_status == zmq.POLLIN:
-                    _ = await pull_socket.recv()  # consume the message 
-                    if not self.start_timer.is_set():
-                        self.start_timer.set()
-                        start = time()
-
-                    async with self.mutex:
-                       logger.debug(f'collector is running {self.total_tokens}')
-                       if self.consumed_tokens >= self.nb_tokens_per_mn - 2 * self.model_token_size:
-                           self.tokens_status.clear()
-                           logger.debug(f'TPM was reached => collector send the stop signal to all workers')
-                       
-                if self.start_timer.is_set():
-                    end = time()
-                    duration = end - start 
-                    logger.debug(f'collector will reset the TPM in {(60 - duration):07.3f} seconds')
-                
-                    if duration > 60:
-                        async with self.mutex:
-                            self.nb_requests = 0 
-                            self.consumed_tokens = 0
-                            self.tokens_status.set()  # allow worker to make request
-                            logger.debug('collector has set the timer')
-                        self.start_timer.clear()  # wait a new response to start the timer 
-
-            # end while loop 
+            async for attempt in retrying:
+                with attempt:
+                    logger.debug('%s is running >> attempt : %d and is waiting the TPM signal', worker_id, attempt.retry_state.attempt_number)
+                    # reserve the worst case => waiting workers are served one after another 
+                    await self.tpm_limiter.acquire(reserved_tokens)
+                    logger.debug('%s has received the TPM signal', worker_id)
+                    try:
+                        await self.rpm_limiter.acquire()
+                        async with self.concurrency_limiter:  # bounds in-flight requests 
+                            post_response = await self.client.post(
+                                url='https://api.openai.com/v1/chat/completions',
+                                content=payload  # Content-Type is already set in the client headers 
+                            )   
+                        outgoing_messages[:], consumed_tokens = await self.worker_strategy(post_response, reserved_tokens)
+                    except BaseException:
+                        self.tpm_limiter.charge(-reserved_tokens)  # the attempt failed => refund its reservation 
+                        raise 
+        except httpx.TimeoutException:
+            logger.warning('%s has timeouted', worker_id)
+        except httpx.TransportError as e:
+            logger.warning('%s has failed with a transport error => %s', worker_id, e)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == 401:  # authorization failed 
+                logger.error('authorization failed => check the openai api key')
+            logger.warning('%s has failed with status code %d', worker_id, e.response.status_code)
+        except msgspec.ValidationError as e:
+            logger.error('%s has received an invalid message => %s', worker_id, e)
         except asyncio.CancelledError:
-            logger.warning('collector was cancelled')
+            logger.warning('%s was cancelled', worker_id)
+            raise  # the pool worker must stop instead of picking up the next conversation 
         except Exception as e:
             logger.error(e)
         
-        pull_socket.close(linger=0)
-        logger.debug('collector has released its ressources')
-
-    async def worker_strategy(self, push_socket:aiozmq.Socket, post_response:httpx.Response) -> Tuple[Optional[Message], bool]:
-        outgoing_message, keep_loop = None, False    
-        try:
-            status_code = post_response.status_code
-            if status_code == 200:  # successfull response 
-                content = post_response.json()
-                consumed_tokens = content['usage']['total_tokens']
-                async with self.mutex:
-                    self.total_tokens = self.total_tokens + consumed_tokens
-                    self.consumed_tokens = self.consumed_tokens + consumed_tokens
-                outgoing_message = Message(**content['choices'][0]['message'])
-                push_socket.send(b'...')  # tell the collector that we have a new response 
-                keep_loop = False             
-            elif status_code == 401:  # authorization failed 
-                keep_loop = False  
-            elif status_code == 429 or status_code == 500:  # internal server or rate limit 
-                keep_loop = True 
-            else:
-                keep_loop= False 
-        except Exception as e:
-            logger.error(e)
-        return outgoing_message, keep_loop
-
-    async def worker(self, worker_id:str, nb_retries:int, client:httpx.AsyncClient, messages:List[Message]) -> Optional[Message]:
-        push_socket:aiozmq.Socket = self.ctx.socket(zmq.PUSH)
-        push_socket.connect(self.collector_address)
-
-        delay = 0
-        counter = 0
-        keep_loop = True
-        outgoing_message = None  
+        nb_missing = nb_choices - sum(msg is not None for msg in outgoing_messages)
+        if nb_choices > 1 and nb_missing > 0:  # a failed grouped request leaves several conversations without response 
+            logger.warning('%s => %d of the %d grouped conversations have no response', worker_id, nb_missing, nb_choices)
+        logger.debug('%s has released its ressources', worker_id)
+        return outgoing_messages, consumed_tokens
+
+    async def pool_worker(self, conversations_queue:asyncio.Queue, responses:List[Optional[Message]], usage:Dict[str, int]):
+        while not conversations_queue.empty():
+            indices, messages = conversations_queue.get_nowait()
+            outgoing_messages, consumed_tokens = await self.worker(
+                worker_id=str(uuid4()), 
+                nb_retries=3,
+                messages=messages,
+                nb_choices=len(indices)
+            )
+            usage['total_tokens'] += consumed_tokens  # shared by the pool of this swarm call only 
+            for index, outgoing_message in zip(indices, outgoing_messages):
+                responses[index] = outgoing_message 
+
+    async def swarm(self, conversations:List[List[Message]]) -> Optional[List[Optional[Message]]]:
+        groups:Dict[Tuple[Message, ...], List[int]] = {}
+        for index, messages in enumerate(conversations):
+            groups.setdefault(tuple(messages), []).append(index)  # identical conversations share one request 
         
-        while keep_loop:
-            try:
-                async with self.mutex:
-                    self.nb_requests = self.nb_requests + 1 
-                    delay = self.period * (self.nb_requests - 1)
-                
-                await asyncio.sleep(delay)
-                logger.debug(f'{worker_id} is running >> nb_retries : {counter} and is waiting the TPM signal')
-                
-                async with self.mutex:
-                    tpm_signal = self.tokens_status.is_set()
-                
-                if tpm_signal:
-                    logger.debug(f'{worker_id} has received the TPM signal')
-                    post_response = await client.post(
-                        url='https://api.openai.com/v1/chat/completions',
-                        json={
-                            'model': 'gpt-3.5-turbo',
-                            'messages': list(map(
-                                lambda msg: msg.dict(),
-                                messages
-                            )) 
-                        },
-                        timeout=10
-                    )   
-                    outgoing_message, keep_loop = await self.worker_strategy(push_socket, post_response)
-                    counter = counter + int(keep_loop)  # 1 or 0 depends on the status of keep loop
-                    
-                else:
-                    await self.tokens_status.wait()
-
-            except httpx.TimeoutException:
-                logger.warning(f'{worker_id} has timeouted')
-                counter = counter + 1  
-            except asyncio.CancelledError:
-                logger.warning(f'{worker_id} was cancelled')
-                keep_loop = False 
-            except Exception as e:
-                logger.error(e)
-                keep_loop = False 
-            keep_loop = keep_loop and counter < nb_retries
-        # end while loop ...!
-        push_socket.close(linger=0) 
-        logger.debug(f'{worker_id} has released its ressources')
-        return outgoing_message
-
-    async def swarm(self, conversations:List[List[Message]]) -> Optional[List[Message]]:
-        self.nb_requests = 0 
-        self.total_tokens = 0 
-        self.consumed_tokens = 0 
-        self.tokens_status.set()  # consumed_tokens == 0 => let workers start making requests 
-
-        collector_task = asyncio.create_task(
-            coro=self.collector()
-        )
+        conversations_queue:asyncio.Queue = asyncio.Queue()  # owned by this call => concurrent swarms stay isolated 
+        for messages, indices in groups.items():
+            for start in range(0, len(indices), self.max_choices_per_request):
+                conversations_queue.put_nowait((indices[start:start + self.max_choices_per_request], list(messages)))
 
         worker_responses = None 
+        usage:Dict[str, int] = {'total_tokens': 0}  # owned by this call => concurrent swarms count their own tokens 
+        pool_tasks:List[asyncio.Task] = []
+        self.active_swarms[conversations_queue] = pool_tasks  # stop_swarm drains and cancels the active swarms 
         try:
-            async with httpx.AsyncClient(headers=self.headers) as client:
-                awaitables = []
-                for messages in conversations:
-                    worker_id = str(uuid4())
-                    task = asyncio.create_task(
-                        coro=self.worker(
-                            worker_id=worker_id, 
-                            nb_retries=3,
-                            client=client,
-                            messages=messages
-                        ),
-                        name=f'worker-{worker_id}'
-                    )
-                    awaitables.append(task)
-                
-                worker_responses = await asyncio.gather(*awaitables, return_exceptions=False)
-        except asyncio.CancelledError:
+            responses:List[Optional[Message]] = [None] * len(conversations)
+            for pool_index in range(min(self.max_concurrent, conversations_queue.qsize())):  # only K requests in flight 
+                task = asyncio.create_task(
+                    coro=self.pool_worker(conversations_queue, responses, usage),
+                    name=f'worker-{pool_index:03d}'
+                )
+                pool_tasks.append(task)
+            
+            # pool tasks cancelled by stop_swarm end up in the results => partial responses are kept 
+            await asyncio.gather(*pool_tasks, return_exceptions=True)
+            worker_responses = responses 
+        except asyncio.CancelledError:  # only raised here when the caller cancelled swarm itself 
             logger.debug('swarm was cancelled...!')
+            raise  # the caller requested the cancellation, it must not be swallowed 
         except Exception as e:
             logger.error(e)
+        finally:
+            del self.active_swarms[conversations_queue]
+            self.drain_conversations(conversations_queue)
+            for task in pool_tasks:
+                task.cancel()  # no-op for the tasks that are already done 
+            await asyncio.gather(*pool_tasks, return_exceptions=True)
         
-        collector_task.cancel()
-        await collector_task
+        logger.debug('swarm has consumed %d tokens', usage['total_tokens'])
         return worker_responses     
 
     async def __aenter__(self):
-        self.mutex = asyncio.Lock()
-        self.tokens_status = asyncio.Event()
-        self.start_timer = asyncio.Event()
-
-        self.ctx = aiozmq.Context()
-        self.loop = asyncio.get_running_loop()
-        self.loop.add_signal_handler(
-            sig=signal.SIGINT,
-            callback=self.stop_swarm 
+        self.concurrency_limiter = asyncio.Semaphore(self.max_concurrent)
+        self.active_swarms:Dict[asyncio.Queue, List[asyncio.Task]] = {}  # conversations queue => pool tasks 
+
+        self.client = httpx.AsyncClient(
+            headers=self.headers,
+            limits=self._limits,
+            timeout=self._timeout,
+            http2=True
         )
+        try:
+            await self.client.__aenter__()  # the pool is shared by all swarm calls 
+            try:
+                await self.client.get(url='https://api.openai.com/v1/models', timeout=5)  # warm up the pool (TLS handshake) 
+            except httpx.HTTPError as e:
+                logger.warning('connection warmup failed => %s', e)
+
+            self.loop = asyncio.get_running_loop()
+            try:
+                self.loop.add_signal_handler(
+                    sig=signal.SIGINT,
+                    callback=self.stop_swarm 
+                )
+            except (NotImplementedError, RuntimeError):  # windows event loops or a loop running outside the main thread 
+                logger.warning('SIGINT handler is not available => stop_swarm must be called explicitly')
+        except BaseException:
+            await self.client.aclose()  # __aexit__ is not called when __aenter__ fails 
+            raise 
         logger.debug('swarm was initalized')
         return self 
     
     async def __aexit__(self, exc_type, exc_value, traceback):
         if exc_type:
-            logger.warning(f'Exception => {exc_value}')
+            logger.warning('Exception => %s', exc_value)
             logger.exception(traceback)
-        if self.loop.is_running():
-            self.loop.stop()
-
-        self.ctx.term()
+        try:
+            self.loop.remove_signal_handler(signal.SIGINT)  # ctrl+c must interrupt the program again 
+        except (NotImplementedError, RuntimeError):
+            pass 
+        await self.client.aclose()
         logger.debug('swarm was released')
 
 
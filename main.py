@@ -1,14 +1,20 @@
 import click 
 import asyncio 
 
+try:
+    import uvloop 
+except ImportError:  # uvloop does not support windows 
+    uvloop = None 
+
 from libraries.swarming import GPTSwarm
 from dataschema import Message, Role
 
 async def run_model(openai_api_key:str):
     async with GPTSwarm(openai_api_key=openai_api_key, nb_tokens_per_mn=180_000, nb_requests_per_mn=3000, model_token_size=4096) as model:
+        shared_message = Message(role=Role.USER, content='Please explain me the big bang in simple terms')
         swarm_response = await model.swarm(
             conversations=[ 
-                [Message(role=Role.USER, content='Please explain me the big bang in simple terms')] 
+                [shared_message] 
                 for _ in range(32)  # 32 conversations in parallel
             ]
         ) 
@@ -26,6 +32,8 @@ def group(ctx:click.core.Context, openai_api_key:str):
 @group.command()
 @click.pass_context
 def start_swarming(ctx:click.core.Context):
+    if uvloop is not None:
+        uvloop.install()
     asyncio.run(run_model(ctx.obj['openai_api_key']))
 
 if __name__ == '__main__':